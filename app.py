@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import sys
+import time
+import queue
 import logging
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
@@ -20,6 +22,12 @@ try:
 except Exception as e:
     raise RuntimeError(f"No se pudo importar midi_to_sidecar.py: {e}")
 
+# Logs del worker: se encolan y el hilo GUI los vuelca por lotes cada LOG_FLUSH_MS
+LOG_FLUSH_MS = 50
+LOG_BATCH_MAX = 500
+# Intervalo mínimo entre actualizaciones de la barra de progreso (~60 fps)
+PROGRESS_MIN_INTERVAL = 0.016
+
 
 # --------- Logging a QTextEdit ---------
 class QtLogHandler(logging.Handler):
@@ -44,79 +52,88 @@ class Worker(QtCore.QObject):
     stage = QtCore.Signal(str)              # texto de etapa
     finished = QtCore.Signal(str)           # ruta YAML
     error = QtCore.Signal(str)              # mensaje de error
-    log = QtCore.Signal(str)                # log stream
 
-    def __init__(self, mid_path: Path):
+    def __init__(self, mid_path: Path, log_queue: queue.SimpleQueue):
         super().__init__()
         self.mid_path = Path(mid_path)
+        self._log_queue = log_queue
+        self._last_progress = 0.0
 
     def _emit_log(self, level, msg):
-        self.log.emit(f"[{level}] {msg}")
+        # Sin señal por línea: MainWindow._drain_logs vacía la cola en el hilo GUI
+        self._log_queue.put((time.time(), logging.getLevelName(level), msg))
+
+    def _emit_progress(self, value):
+        # Limita la frecuencia de repintado; 0 y 100 siempre se emiten
+        now = time.monotonic()
+        if value in (0, 100) or now - self._last_progress >= PROGRESS_MIN_INTERVAL:
+            self.progress.emit(value)
+            self._last_progress = now
+
+    def _analyze(self, mid_path: Path) -> dict:
+        """Lectura + análisis completo del MIDI (8 compases) -> dict del sidecar."""
+        self.stage.emit("Cargando MIDI y leyendo notas...")
+        self._emit_progress(3)
+        notes_np, (num, den), ppq = conv.load_notes(mid_path)
+        self._emit_log("INFO", f"Cargado {mid_path.name} (PPQ={ppq})")
+
+        self._emit_log("INFO", f"Compás detectado: {num}/{den}")
+        if (num, den) != (4, 4):
+            self._emit_log("WARN", f"Time Signature {num}/{den} (se esperaba 4/4). Se continúa.")
+
+        bar_ticks = ppq * 4 * num // den
+        self._emit_progress(10)
+        if notes_np[0].size == 0:
+            raise ValueError("No se encontraron notas (¿MIDI vacío o sólo percusión?).")
+
+        end_max = int(notes_np[1].max())
+        min_needed = bar_ticks * 8
+        if end_max < min_needed:
+            self._emit_log("WARN", f"El MIDI parece menor a 8 compases ({end_max} < {min_needed}). Se analizarán 8 compases igualmente.")
+
+        # Global hist + key/mode
+        self.stage.emit("Detectando tonalidad...")
+        self._emit_progress(25)
+        global_hist = conv.weighted_pc_hist(notes_np, 0, min_needed)
+        key_name, mode = conv.choose_key_mode(global_hist)
+        key_pc = conv.NAME_TO_PC[key_name]
+        self._emit_log("INFO", f"Estimado: key={key_name} mode={mode}")
+
+        # 16 medios compases en un solo producto matricial
+        H, totals = conv.segment_histograms(notes_np, conv.half_bar_boundaries(bar_ticks))
+        romans, _ = conv.best_romans_for_segments(H, totals, key_pc, mode)
+
+        # Barras
+        bars = []
+        for bar_idx in range(8):
+            self.stage.emit(f"Analizando compás {bar_idx+1}/8")
+            r1, r2 = romans[2*bar_idx], romans[2*bar_idx + 1]
+
+            if r1 == r2:
+                bars.append(r1)
+                self._emit_log("INFO", f"Bar {bar_idx+1}: {r1}")
+            else:
+                bars.append(f"{r1}|{r2}")
+                self._emit_log("INFO", f"Bar {bar_idx+1}: {r1}|{r2}")
+
+            # Progreso: 25 -> 90 lineal a 8 compases
+            self._emit_progress(25 + int((bar_idx+1) * (65/8)))
+
+        return {'key': key_name, 'mode': mode, 'bars': bars}
 
     @QtCore.Slot()
     def run(self):
         try:
-            self.stage.emit("Cargando MIDI...")
-            self.progress.emit(3)
-            mid = conv.MidiFile(self.mid_path)
-            ppq = mid.ticks_per_beat
-            self._emit_log("INFO", f"Cargado {self.mid_path.name} (PPQ={ppq})")
-
-            num, den = conv.read_first_timesig(mid)
-            self._emit_log("INFO", f"Compás detectado: {num}/{den}")
-            if (num, den) != (4, 4):
-                self._emit_log("WARN", f"Time Signature {num}/{den} (se esperaba 4/4). Se continúa.")
-
-            bar_ticks = int(ppq * 4 * (num/den))
-            self.stage.emit("Leyendo notas...")
-            self.progress.emit(10)
-            notes = conv.collect_note_intervals(mid)
-            if not notes:
-                raise ValueError("No se encontraron notas (¿MIDI vacío o sólo percusión?).")
-
-            end_max = max(e for _,e,_,_,_ in notes)
-            min_needed = bar_ticks * 8
-            if end_max < min_needed:
-                self._emit_log("WARN", f"El MIDI parece menor a 8 compases ({end_max} < {min_needed}). Se analizarán 8 compases igualmente.")
-
-            # Global hist + key/mode
-            self.stage.emit("Detectando tonalidad...")
-            self.progress.emit(25)
-            global_hist = conv.weighted_pc_hist(notes, 0, min_needed)
-            key_name, mode = conv.choose_key_mode(global_hist)
-            key_pc = conv.NAME_TO_PC[key_name]
-            self._emit_log("INFO", f"Estimado: key={key_name} mode={mode}")
-
-            # Barras
-            bars = []
-            for bar_idx in range(8):
-                self.stage.emit(f"Analizando compás {bar_idx+1}/8")
-                s = bar_ticks * bar_idx
-                e = s + bar_ticks
-                midpt = s + bar_ticks//2
-                r1, c1 = conv.best_roman_for_segment(notes, key_pc, mode, s, midpt)
-                r2, c2 = conv.best_roman_for_segment(notes, key_pc, mode, midpt, e)
-
-                if r1 == r2:
-                    bars.append(r1)
-                    self._emit_log("INFO", f"Bar {bar_idx+1}: {r1}")
-                else:
-                    bars.append(f"{r1}|{r2}")
-                    self._emit_log("INFO", f"Bar {bar_idx+1}: {r1}|{r2}")
-
-                # Progreso: 25 -> 90 lineal a 8 compases
-                self.progress.emit(25 + int((bar_idx+1) * (65/8)))
-
-            data = {'key': key_name, 'mode': mode, 'bars': bars}
+            data, from_cache = conv.midi_to_yaml_sidecar_cached(self.mid_path, self._analyze)
+            if from_cache:
+                self._emit_log("INFO", f"{self.mid_path.name} sin cambios: se reutiliza el análisis anterior")
 
             # Guardar YAML junto al .mid
-            import yaml
             yml_path = self.mid_path.with_suffix('.yml')
-            with open(yml_path, 'w', encoding='utf-8') as f:
-                yaml.safe_dump(data, f, sort_keys=False, allow_unicode=True)
+            conv.write_sidecar(data, yml_path)
 
             self.stage.emit("¡Listo!")
-            self.progress.emit(100)
+            self._emit_progress(100)
             self._emit_log("INFO", f"Generado: {yml_path}")
             self.finished.emit(str(yml_path))
         except Exception as ex:
@@ -170,13 +187,14 @@ class MainWindow(QMainWindow):
         # Wire logging to GUI + archivo
         self._setup_logging()
 
-        # Estilo oscuro
-        try:
-            # QDarkStyle v3
-            self.setStyleSheet(qdarkstyle.load_stylesheet(qt_api='pyside6'))
-        except Exception:
-            # Fallback genérico
-            self.setStyleSheet(qdarkstyle.load_stylesheet())
+        # Cola de logs del worker, volcada por lotes con un QTimer (activo sólo durante on_run)
+        self._log_queue = queue.SimpleQueue()
+        self._log_timer = QtCore.QTimer(self)
+        self._log_timer.setInterval(LOG_FLUSH_MS)
+        self._log_timer.timeout.connect(self._drain_logs)
+
+        # Estilo oscuro: tras el primer pintado de la ventana
+        QtCore.QTimer.singleShot(0, self._apply_style)
 
         # Eventos
         self.le_path.textChanged.connect(lambda t: self.btn_run.setEnabled(bool(t.strip())))
@@ -185,6 +203,14 @@ class MainWindow(QMainWindow):
         self._thread = None
         self._worker = None
 
+    def _apply_style(self):
+        try:
+            # QDarkStyle v3
+            self.setStyleSheet(qdarkstyle.load_stylesheet(qt_api='pyside6'))
+        except Exception:
+            # Fallback genérico
+            self.setStyleSheet(qdarkstyle.load_stylesheet())
+
     def _setup_logging(self):
         self.logger = logging.getLogger("gui")
         self.logger.setLevel(logging.INFO)
@@ -203,16 +229,38 @@ class MainWindow(QMainWindow):
                     QtCore.Q_ARG(str, msg)
                 )
 
+        self._log_fmt = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
         h_gui = TextEditHandler(self.txt_logs)
-        h_gui.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        h_gui.setFormatter(self._log_fmt)
         self.logger.addHandler(h_gui)
 
         # Handler a archivo rotativo en home
         log_path = Path.home() / ".midi2yaml_gui.log"
         h_file = RotatingFileHandler(log_path, maxBytes=512*1024, backupCount=3, encoding='utf-8')
-        h_file.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        h_file.setFormatter(self._log_fmt)
         self.logger.addHandler(h_file)
 
+        # Logs del worker: sólo al archivo (una entrada por línea); al QTextEdit van por lotes
+        self.worker_logger = logging.getLogger("gui.worker")
+        self.worker_logger.setLevel(logging.INFO)
+        self.worker_logger.propagate = False
+        self.worker_logger.addHandler(h_file)
+
+    def _drain_logs(self, limit=LOG_BATCH_MAX):
+        lines = []
+        while limit is None or len(lines) < limit:
+            try:
+                created, levelno, msg = self._log_queue.get_nowait()
+            except queue.Empty:
+                break
+            record = self.worker_logger.makeRecord(self.worker_logger.name, levelno, __file__, 0, msg, None, None)
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+            self.worker_logger.handle(record)
+            lines.append(self._log_fmt.format(record))
+        if lines:
+            self.txt_logs.append("\n".join(lines))
+
     def on_browse(self):
         path, _ = QFileDialog.getOpenFileName(self, "Selecciona MIDI", "", "MIDI (*.mid *.midi)")
         if path:
@@ -234,14 +282,13 @@ class MainWindow(QMainWindow):
 
         # Crear worker en QThread
         self._thread = QtCore.QThread(self)
-        self._worker = Worker(p)
+        self._worker = Worker(p, self._log_queue)
         self._worker.moveToThread(self._thread)
 
         # Conexiones
         self._thread.started.connect(self._worker.run)
         self._worker.stage.connect(self.lbl_stage.setText)
         self._worker.progress.connect(self.pbar.setValue)
-        self._worker.log.connect(lambda m: self.logger.info(m))
         self._worker.finished.connect(self._on_finished)
         self._worker.error.connect(self._on_error)
 
@@ -252,10 +299,13 @@ class MainWindow(QMainWindow):
         self._worker.error.connect(self._thread.quit)
         self._worker.error.connect(self._worker.deleteLater)
 
+        self._log_timer.start()
         self._thread.start()
 
     @QtCore.Slot(str)
     def _on_finished(self, yml_path):
+        self._log_timer.stop()
+        self._drain_logs(limit=None)
         self.logger.info(f"YAML generado: {yml_path}")
         self.lbl_stage.setText("Completado.")
         self.btn_run.setEnabled(True)
@@ -263,6 +313,8 @@ class MainWindow(QMainWindow):
 
     @QtCore.Slot(str)
     def _on_error(self, msg):
+        self._log_timer.stop()
+        self._drain_logs(limit=None)
         self.logger.error(msg)
         self.lbl_stage.setText("Error.")
         self.btn_run.setEnabled(True)
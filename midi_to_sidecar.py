@@ -1,13 +1,28 @@
 # midi_to_sidecar.py
 # Convierte un MIDI (8 compases, 4/4) a un sidecar YAML con: key, mode, bars[8]
-# Requiere: mido, pyyaml  ->  pip install mido PyYAML
+# Requiere: mido, pyyaml, numpy, symusic  ->  pip install -r requirements.txt
+# symusic (parser C++) es el lector por defecto; si no se puede importar o falla con un
+# archivo, se usa mido (parse_midi), que empareja las notas igual.
 
 import sys
+import copy
 from pathlib import Path
-from typing import List, Tuple, Dict
+from typing import Callable, List, Tuple, Dict, Optional
 import math
+import numpy as np
 import yaml
-from mido import MidiFile, MetaMessage
+from collections import deque
+from mido import MidiFile
+
+try:
+    from yaml import CSafeDumper as _Dumper
+except ImportError:  # PyYAML sin libyaml
+    from yaml import SafeDumper as _Dumper
+
+try:
+    from symusic import Score
+except ImportError:  # sin wheel/toolchain C++ -> se usa mido
+    Score = None
 
 # -------------------- Utiles de teoría --------------------
 NOTE_NAMES_SHARP = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
@@ -25,93 +40,153 @@ TRIADS_HMIN  = ['m','dim','M','m','M','M','dim']  # pragmático para pop
 # Perfiles Krumhansl (mayor / menor) normalizados aprox.
 # Fuente típica (K-S): mayor=[6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88]
 #                      menor=[6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17]
-KS_MAJOR = [6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88]
-KS_MINOR = [6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17]
-
-def rotate(lst, k):
-    k %= len(lst)
-    return lst[-k:] + lst[:-k]
+KS_MAJOR = np.array([6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88], dtype=np.float32)
+KS_MINOR = np.array([6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17], dtype=np.float32)
 
-def dot(a,b):
-    return sum(x*y for x,y in zip(a,b))
+# Matriz (24, 12) de perfiles rotados: filas 0..11 mayor, 12..23 menor (tónica = fila % 12)
+_KS = np.stack([np.roll(KS_MAJOR, k) for k in range(12)] +
+               [np.roll(KS_MINOR, k) for k in range(12)])
 
 # -------------------- Lectura de notas --------------------
-def track_to_abs_events(track) -> List[Tuple[int, object]]:
-    """Convierte delta times a tiempos absolutos por track."""
-    t = 0
-    abs_events = []
-    for msg in track:
-        t += msg.time
-        abs_events.append((t, msg))
-    return abs_events
-
-def collect_note_intervals(mid: MidiFile) -> List[Tuple[int,int,int,int,int]]:
+def parse_midi(mid: MidiFile):
     """
-    Devuelve lista de notas: (start_tick, end_tick, pitch, channel, velocity)
-    Ignora canal 9 (batería GM).
+    Una sola pasada por los eventos: devuelve (notas, (num, den), ppq).
+    notas: lista de (start_tick, end_tick, pitch, channel, velocity); ignora canal 9 (batería GM).
+    Notas solapadas de la misma (canal, nota) se emparejan en orden FIFO: cada note_off
+    cierra el note_on abierto más antiguo (mismo criterio que symusic).
+    (num, den): time_signature de menor tick; si falta, 4/4.
     """
+    ts = (4, 4)
+    ts_tick = None
     notes = []
     for tr in mid.tracks:
-        on_stack: Dict[Tuple[int,int], Tuple[int,int]] = {}  # (ch,note) -> (start_tick, velocity)
-        abs_events = track_to_abs_events(tr)
-        for t, msg in abs_events:
-            if msg.is_meta:
-                continue
-            if not hasattr(msg, 'channel'):
+        # Notas abiertas en tabla fija 16 canales x 128 notas, índice ch*128+note -> deque[(start, vel)]
+        open_notes = [None] * (16 * 128)
+        t = 0
+        for msg in tr:
+            t += msg.time
+            tp = msg.type
+            if tp != 'note_on' and tp != 'note_off':
+                if tp == 'time_signature' and (ts_tick is None or t < ts_tick):
+                    ts = (msg.numerator, msg.denominator)
+                    ts_tick = t
                 continue
             ch = msg.channel
             if ch == 9:  # canal 10 -> drums
                 continue
-            if msg.type == 'note_on' and msg.velocity > 0:
-                on_stack[(ch, msg.note)] = (t, msg.velocity)
-            elif (msg.type == 'note_off') or (msg.type == 'note_on' and msg.velocity == 0):
-                key = (ch, msg.note)
-                if key in on_stack:
-                    start, vel = on_stack.pop(key)
-                    if t > start:
-                        notes.append((start, t, msg.note, ch, vel))
-    return notes
-
-def read_first_timesig(mid: MidiFile) -> Tuple[int,int]:
-    """Lee primer time_signature (numerador, denominador). Si falta, 4/4."""
-    for tr in mid.tracks:
-        for msg in tr:
-            if isinstance(msg, MetaMessage) and msg.type == 'time_signature':
-                return msg.numerator, msg.denominator
-    return 4,4
+            note = msg.note
+            k = ch * 128 + note
+            q = open_notes[k]
+            if tp == 'note_on' and msg.velocity > 0:
+                if q is None:
+                    q = open_notes[k] = deque()
+                q.append((t, msg.velocity))
+            elif q:  # note_off o note_on con velocity 0
+                start, vel = q.popleft()
+                if t > start:
+                    notes.append((start, t, note, ch, vel))
+    return notes, ts, mid.ticks_per_beat
+
+def _sort_by_start(starts, ends, pcs) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Ordena el SoA por start_tick (estable) para poder acotar búsquedas con searchsorted."""
+    order = np.argsort(starts, kind='stable')
+    return starts[order], ends[order], pcs[order]
+
+def notes_to_soa(notes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pasa la lista de notas (AoS) a arrays paralelos (SoA): (starts, ends, pcs), ordenados por start.
+    """
+    arr = np.array(notes, np.int32).reshape(-1, 5)  # una conversión en C, sin desempaquetar tuplas
+    return _sort_by_start(arr[:, 0], arr[:, 1], (arr[:, 2] % 12).astype(np.uint8))
+
+def _load_notes_symusic(mid_path: Path):
+    """Lee con symusic: notas ya emparejadas y en ticks absolutos, como arrays."""
+    score = Score(str(mid_path), ttype='tick')
+    starts, ends, pcs = [], [], []
+    for tr in score.tracks:
+        if tr.is_drum:  # canal 10 -> drums
+            continue
+        arr = tr.notes.numpy()
+        keep = arr['duration'] > 0
+        start = arr['time'][keep].astype(np.int32)
+        starts.append(start)
+        ends.append(start + arr['duration'][keep].astype(np.int32))
+        pcs.append((arr['pitch'][keep] % 12).astype(np.uint8))
+    if starts:
+        notes_np = _sort_by_start(np.concatenate(starts), np.concatenate(ends), np.concatenate(pcs))
+    else:
+        notes_np = (np.zeros(0, np.int32), np.zeros(0, np.int32), np.zeros(0, np.uint8))
+    if len(score.time_signatures):
+        ts = score.time_signatures[0]
+        num, den = ts.numerator, ts.denominator
+    else:
+        num, den = 4, 4
+    return notes_np, (num, den), score.ticks_per_quarter
+
+def load_notes(mid_path: Path):
+    """
+    Devuelve ((starts, ends, pcs), (num, den), ppq).
+    Usa symusic; si no está instalado o no puede leer el archivo, mido (parse_midi).
+    """
+    if Score is not None:
+        try:
+            return _load_notes_symusic(mid_path)
+        except Exception:
+            pass  # p.ej. bytes fuera de rango que mido tolera con clip=True
+    notes, ts, ppq = parse_midi(MidiFile(mid_path, clip=True))
+    return notes_to_soa(notes), ts, ppq
 
 # -------------------- Histos y segmentación --------------------
-def weighted_pc_hist(notes, start_tick, end_tick) -> List[float]:
+def weighted_pc_hist(notes_np, start_tick, end_tick) -> List[float]:
     """
     Histograma de pitch-class (12) ponderado por duración de solapamiento con [start,end).
     """
-    L = [0.0]*12
-    for s,e,p,ch,vel in notes:
-        if e <= start_tick or s >= end_tick:
-            continue
-        a = max(s, start_tick)
-        b = min(e, end_tick)
-        w = max(0, b - a)
-        if w > 0:
-            L[p % 12] += w
-    return L
+    starts, ends, pcs = notes_np
+    # Notas ordenadas por start: las que empiezan en/después de end_tick no solapan
+    hi = int(np.searchsorted(starts, end_tick, side='left'))
+    starts, ends, pcs = starts[:hi], ends[:hi], pcs[:hi]
+    w = np.clip(np.minimum(ends, end_tick) - np.maximum(starts, start_tick), 0, None)
+    return np.bincount(pcs, weights=w, minlength=12).tolist()
+
+def half_bar_boundaries(bar_ticks: int, n_bars: int = 8) -> List[int]:
+    """Fronteras de medio compás: 0, bar/2, bar, ... , n_bars*bar (2*n_bars+1 puntos)."""
+    half = bar_ticks // 2
+    return [bar_ticks * (i // 2) + half * (i % 2) for i in range(2 * n_bars + 1)]
+
+def build_pc_prefix(notes_np, boundaries: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sumas prefijas en las fronteras: (pc_prefix (12, T), total_prefix (T,)).
+    pc_prefix[:, i] = solapamiento por pitch-class de las notas con [0, boundaries[i]);
+    total_prefix[i] = su suma. Un segmento [b_i, b_j) es la diferencia de columnas j - i.
+    Requiere notes_np ordenado por start (ver notes_to_soa).
+    """
+    starts, ends, pcs = notes_np
+    # Ticks en int32 (SoA), acumuladores en int64 para no desbordar en MIDIs largos
+    acc = np.zeros((12, len(boundaries)), np.int64)
+    total = np.zeros(len(boundaries), np.int64)
+    for bi, b in enumerate(boundaries):
+        hi = int(np.searchsorted(starts, b, side='left'))  # sólo notas que empiezan antes de b
+        weights = np.clip(np.minimum(ends[:hi], b) - starts[:hi], 0, None)
+        np.add.at(acc[:, bi], pcs[:hi], weights)
+        total[bi] = weights.sum(dtype=np.int64)
+    return acc, total
+
+def segment_histograms(notes_np, boundaries: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """(H (n_seg, 12), totals (n_seg,)) de cada segmento [b_i, b_{i+1}) en un solo paso."""
+    pc_prefix, total_prefix = build_pc_prefix(notes_np, boundaries)
+    return np.diff(pc_prefix, axis=1).T, np.diff(total_prefix)
 
 def choose_key_mode(pc_hist: List[float]) -> Tuple[str, str]:
     """
     Estima (key_name, mode_str) usando Krumhansl y decide menor_natural vs menor_armónico
     según presencia de la sensible.
     """
-    # Elegir mayor/minor y tónica (rotación) por correlación
-    best = None
-    best_mode = None
-    best_key_pc = None
-    for mode_name, prof in [('major', KS_MAJOR), ('minor', KS_MINOR)]:
-        for k in range(12):
-            score = dot(pc_hist, rotate(prof, k))
-            if best is None or score > best:
-                best = score
-                best_mode = mode_name
-                best_key_pc = k
+    # Elegir mayor/minor y tónica (rotación) por correlación: un solo producto (24,12)@(12,)
+    h = np.asarray(pc_hist, np.float32)
+    scores = _KS @ h
+    i = int(scores.argmax())
+    best_mode = 'major' if i < 12 else 'minor'
+    best_key_pc = i % 12
     key_name = NOTE_NAMES_SHARP[best_key_pc]
 
     # Si menor: natural vs armónico
@@ -147,7 +222,20 @@ def triad_for_degree(key_pc: int, mode: str, degree_idx: int) -> List[int]:
     if q == 'dim': return [root, (root+3)%12, (root+6)%12]
     return [root, (root+4)%12, (root+7)%12]
 
-def roman_for_degree(mode: str, degree_idx: int) -> str:
+# Máscaras de triadas diatónicas: _TRIAD_MASKS[mode_id, key_pc, degree] = indicador (12,) de sus PCs
+_MODE_ID = {'major':0, 'minor_natural':1, 'minor_harmonic':2}
+
+def _build_triad_masks() -> np.ndarray:
+    masks = np.zeros((len(_MODE_ID), 12, 7, 12), np.float32)
+    for mode, mid in _MODE_ID.items():
+        for key_pc in range(12):
+            for d in range(7):
+                masks[mid, key_pc, d, triad_for_degree(key_pc, mode, d)] = 1.0
+    return masks
+
+_TRIAD_MASKS = _build_triad_masks()
+
+def _build_roman(mode: str, degree_idx: int) -> str:
     """Romano sin tensiones, con ° si es disminuido."""
     romans = ['I','II','III','IV','V','VI','VII']
     if mode == 'major':
@@ -163,61 +251,57 @@ def roman_for_degree(mode: str, degree_idx: int) -> str:
         return r.lower() + '°'
     return r
 
-def best_roman_for_segment(notes, key_pc: int, mode: str, start_tick: int, end_tick: int) -> Tuple[str, float]:
-    """
-    Elige el grado (romano) cuya triada diatónica mejor explica el histograma del segmento.
-    Retorna (romano, cobertura) con cobertura = peso_en_triada / peso_total (0..1).
-    """
-    hist = weighted_pc_hist(notes, start_tick, end_tick)
-    total = sum(hist)
-    if total <= 0:
-        return 'I', 0.0
-    best_score = -1.0
-    best_deg = 0
-    for d in range(7):
-        triad = set(triad_for_degree(key_pc, mode, d))
-        score = sum(hist[pc] for pc in triad)
-        if score > best_score:
-            best_score = score
-            best_deg = d
-    roman = roman_for_degree(mode, best_deg)
-    coverage = best_score / total
-    return roman, coverage
+# ROMAN_TABLE[mode][degree] -> romano, precalculado una vez
+ROMAN_TABLE = {m: [_build_roman(m, d) for d in range(7)] for m in _MODE_ID}
+
+def best_romans_for_segments(H: np.ndarray, totals: np.ndarray, key_pc: int, mode: str) -> Tuple[List[str], List[float]]:
+    """
+    Elige, para cada segmento, el grado (romano) cuya triada diatónica mejor explica su
+    histograma. H es (n_seg, 12), totals (n_seg,); los n_seg x 7 scores salen de un único
+    producto matricial. Retorna (romanos, coberturas) con cobertura = peso_en_triada / peso_total.
+    """
+    S = np.asarray(H, np.float32) @ _TRIAD_MASKS[_MODE_ID[mode], key_pc].T  # (n_seg, 7)
+    degs = S.argmax(axis=1)
+    table = ROMAN_TABLE[mode]
+    romans, coverages = [], []
+    for i, d in enumerate(degs.tolist()):
+        if totals[i] <= 0:
+            romans.append('I')
+            coverages.append(0.0)
+        else:
+            romans.append(table[d])
+            coverages.append(float(S[i, d] / totals[i]))
+    return romans, coverages
 
 # -------------------- Conversión principal --------------------
 def midi_to_yaml_sidecar(mid_path: Path) -> Dict:
-    mid = MidiFile(mid_path)
-    ppq = mid.ticks_per_beat
-    num, den = read_first_timesig(mid)
+    notes_np, (num, den), ppq = load_notes(mid_path)
     if num != 4 or den != 4:
         print(f"[WARN] Time Signature {num}/{den} detectado (se esperaba 4/4). Se continuará igualmente.")
-    bar_ticks = int(ppq * 4 * (num/den))  # para 4/4, es 4*ppq
-
-    notes = collect_note_intervals(mid)
+    bar_ticks = ppq * 4 * num // den  # para 4/4, es 4*ppq (entero exacto)
 
     # Longitud total y verificación mínima de 8 compases
-    if not notes:
+    if notes_np[0].size == 0:
         raise ValueError("No se encontraron notas (¿MIDI vacío o sólo percusión?).")
-    end_max = max(e for _,e,_,_,_ in notes)
+    end_max = int(notes_np[1].max())
     min_needed = bar_ticks * 8
     if end_max < min_needed:
         print(f"[WARN] El MIDI parece tener menos de 8 compases ({end_max} ticks < {min_needed}). Se analizarán los primeros 8 compases igualmente, pudiendo haber silencio al final.")
 
     # Histograma global y estimación de tonalidad/modo
-    global_hist = weighted_pc_hist(notes, 0, min_needed)
+    global_hist = weighted_pc_hist(notes_np, 0, min_needed)
     key_name, mode = choose_key_mode(global_hist)
     key_pc = NAME_TO_PC[key_name]
     print(f"[INFO] Estimado: key={key_name} mode={mode}")
 
+    # 16 medios compases analizados de una vez
+    H, totals = segment_histograms(notes_np, half_bar_boundaries(bar_ticks))
+    romans, _ = best_romans_for_segments(H, totals, key_pc, mode)
+
     bars = []
     for bar_idx in range(8):
-        s = bar_ticks * bar_idx
-        e = s + bar_ticks
-
         # Mitades del compás
-        midpt = s + bar_ticks//2
-        r1, c1 = best_roman_for_segment(notes, key_pc, mode, s, midpt)
-        r2, c2 = best_roman_for_segment(notes, key_pc, mode, midpt, e)
+        r1, r2 = romans[2*bar_idx], romans[2*bar_idx + 1]
 
         if r1 == r2:
             bars.append(r1)
@@ -231,6 +315,32 @@ def midi_to_yaml_sidecar(mid_path: Path) -> Dict:
     }
     return data
 
+# -------------------- Caché en memoria --------------------
+# (ruta absoluta, mtime_ns, tamaño) -> sidecar; evita reanalizar un MIDI sin cambios
+_SIDECAR_CACHE: Dict[Tuple[str, int, int], Dict] = {}
+
+def _sidecar_cache_key(mid_path: Path) -> Tuple[str, int, int]:
+    st = mid_path.stat()
+    return str(mid_path.resolve()), st.st_mtime_ns, st.st_size
+
+def midi_to_yaml_sidecar_cached(mid_path: Path, analyze: Optional[Callable[[Path], Dict]] = None) -> Tuple[Dict, bool]:
+    """
+    Sidecar memoizado por (ruta, mtime, tamaño). analyze hace el análisis en caso de fallo
+    de caché (por defecto midi_to_yaml_sidecar). Retorna (copia del sidecar, vino_de_caché).
+    """
+    key = _sidecar_cache_key(mid_path)
+    data = _SIDECAR_CACHE.get(key)
+    hit = data is not None
+    if not hit:
+        data = (analyze or midi_to_yaml_sidecar)(mid_path)
+        _SIDECAR_CACHE[key] = copy.deepcopy(data)
+    return copy.deepcopy(data), hit
+
+def write_sidecar(data: Dict, yml_path: Path) -> None:
+    """Escribe el sidecar YAML (usa el dumper C de libyaml si está disponible)."""
+    with open(yml_path, 'w', encoding='utf-8') as f:
+        yaml.dump(data, f, Dumper=_Dumper, sort_keys=False, allow_unicode=True)
+
 def main():
     if len(sys.argv) < 2:
         print("Uso: python midi_to_sidecar.py <archivo.mid>")
@@ -242,8 +352,7 @@ def main():
 
     sidecar = midi_to_yaml_sidecar(mid_path)
     yml_path = mid_path.with_suffix('.yml')
-    with open(yml_path, 'w', encoding='utf-8') as f:
-        yaml.safe_dump(sidecar, f, sort_keys=False, allow_unicode=True)
+    write_sidecar(sidecar, yml_path)
     print(f"[OK] Generado: {yml_path}")
 
 if __name__ == "__main__":